@@ -1,14 +1,17 @@
 import datetime
 import logging
 
-import six
-from sys import getsizeof
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from gridfs.grid_file import DEFAULT_CHUNK_SIZE
 from pymongo import errors
 from pymongo.mongo_client import MongoClient
 from pymongo.mongo_replica_set_client import MongoReplicaSetClient
+from pymongo.operations import ReplaceOne
 from pymongo.read_preferences import ReadPreference
-import gridfs
 from scrapy.exporters import BaseItemExporter
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
 
 
 def not_set(string):
@@ -23,6 +26,41 @@ def not_set(string):
     return False
 
 
+def _approx_bytes(value):
+    """Cheaply estimate the stored size of a value.
+
+    Only binary and text values are measured, for text the number of
+    characters is used instead of encoding a copy of the string.
+
+    :returns: int - The approximate size in bytes, 0 for other types
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    elif isinstance(value, str):
+        return len(value)
+    return 0
+
+
+def _exceeds_bytes(value, max_size_bytes):
+    """Check if a value is larger than a number of bytes once stored.
+
+    Text is only encoded to UTF-8 when its number of characters alone
+    cannot tell, as UTF-8 uses between one and four bytes per character.
+
+    :returns: bool - True if the value is larger than max_size_bytes
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value) > max_size_bytes
+    elif isinstance(value, str):
+        length = len(value)
+        if length > max_size_bytes:
+            return True
+        elif 4 * length <= max_size_bytes:
+            return False
+        return len(value.encode('utf-8', 'surrogatepass')) > max_size_bytes
+    return False
+
+
 class MongoDBPipeline(BaseItemExporter):
     """MongoDB pipeline."""
 
@@ -35,17 +73,23 @@ class MongoDBPipeline(BaseItemExporter):
         'collection': 'items',
         'separate_collections': False,
         'replica_set': None,
+        'max_pool_size': None,
+        'min_pool_size': None,
+        'compressors': None,
         'unique_key': None,
         'buffer': None,
+        'buffer_bytes': None,
+        'thread_pool_size': 10,
         'append_timestamp': False,
         'stop_on_duplicate': 0,
         'grid_fs_threshold_bytes': None,
         'grid_fs_field_tag': 'big_field',
+        'grid_fs_chunk_size': DEFAULT_CHUNK_SIZE,
     }
 
     # Item buffer
     current_item = 0
-    item_buffer = []
+    current_bytes = 0
 
     # Duplicate key occurence count
     duplicate_key_count = 0
@@ -55,6 +99,20 @@ class MongoDBPipeline(BaseItemExporter):
         super(MongoDBPipeline, self).__init__(**kwargs)
         self.logger = logging.getLogger('scrapy-mongodb-pipeline')
 
+        # Item buffer, the items and their GridFS field keys are kept in
+        # parallel lists so they can be handed to insert_item as they are
+        self._items_buf = []
+        self._grid_fields_buf = []
+
+        # GridFS tagged field names per Item class
+        self._grid_field_cache = {}
+
+        # Names of the collections with an ensured unique index
+        self._indexed_collections = set()
+
+        # Whether the GridFS indexes have been ensured
+        self._grid_fs_indexed = False
+
     def load_spider(self, spider):
         self.crawler = spider.crawler
         self.settings = spider.settings
@@ -69,24 +127,57 @@ class MongoDBPipeline(BaseItemExporter):
         # Configure the connection
         self.configure()
 
+        # Connection pool and compression options are left to the driver
+        # (or the URI) unless they are configured
+        client_options = {}
+        for option, key in (('maxPoolSize', 'max_pool_size'),
+                            ('minPoolSize', 'min_pool_size'),
+                            ('compressors', 'compressors')):
+            if self.config[key] is not None:
+                client_options[option] = self.config[key]
+
         if self.config['replica_set'] is not None:
             connection = MongoReplicaSetClient(
                 self.config['uri'],
                 replicaSet=self.config['replica_set'],
                 w=self.config['write_concern'],
                 fsync=self.config['fsync'],
-                read_preference=ReadPreference.PRIMARY_PREFERRED)
+                read_preference=ReadPreference.PRIMARY_PREFERRED,
+                **client_options)
         else:
             # Connecting to a stand alone MongoDB
             connection = MongoClient(
                 self.config['uri'],
+                w=self.config['write_concern'],
                 fsync=self.config['fsync'],
-                read_preference=ReadPreference.PRIMARY)
+                read_preference=ReadPreference.PRIMARY,
+                **client_options)
 
         # Set up the database
         self.database = connection[self.config['database']]
         self.collections = {'default': self.database[self.config['collection']]}
-        self.grid_fs = gridfs.GridFS(self.database)
+        self.grid_fs_files = self.database['fs.files']
+        self.grid_fs_chunks = self.database['fs.chunks']
+
+        # Writes run in a thread pool of their own, so they do not hold up
+        # DNS lookups and other users of the reactor thread pool.
+        # With a unique key the pool has a single thread: upserts of the same
+        # key must reach the server in the order the items were scraped, so
+        # an older item never overwrites a newer one, and the pool runs its
+        # jobs first in, first out.
+        if self.config['unique_key'] is None:
+            thread_pool_size = self.config['thread_pool_size']
+        else:
+            thread_pool_size = 1
+
+        from twisted.internet import reactor
+        self.thread_pool = ThreadPool(
+            minthreads=0,
+            maxthreads=thread_pool_size,
+            name='scrapy-mongodb')
+        self.thread_pool.start()
+        self._thread_pool_trigger = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self.thread_pool.stop)
 
         self.logger.info(u'Connected to MongoDB {0}, using "{1}"'.format(
             self.config['uri'],
@@ -107,9 +198,34 @@ class MongoDBPipeline(BaseItemExporter):
 
             self.stop_on_duplicate = self.config['stop_on_duplicate']
 
+            # Unacknowledged writes never report duplicate keys
+            if self.config['write_concern'] == 0:
+                self.logger.warning(
+                    u'MONGODB_STOP_ON_DUPLICATE has no effect with '
+                    u'MONGODB_REPLICA_SET_W = 0, duplicate keys are only '
+                    u'reported for acknowledged writes')
+
         else:
             self.stop_on_duplicate = 0
 
+        # Options used for every item
+        self._grid_tag = self.config['grid_fs_field_tag']
+        self._grid_thresh = self.config['grid_fs_threshold_bytes']
+        self._buf_size = self.config['buffer']
+        self._buf_bytes = self.config['buffer_bytes']
+        self._append_ts = self.config['append_timestamp']
+        self._unique_key = self.config['unique_key']
+
+        # Build the unique key extractor once for the configured key
+        if self._unique_key is None:
+            self._make_key = None
+        elif isinstance(self._unique_key, list):
+            key_names = tuple(dict(self._unique_key).keys())
+            self._make_key = lambda document: {k: document[k] for k in key_names}
+        else:
+            key_name = self._unique_key
+            self._make_key = lambda document: {key_name: document[key_name]}
+
     def configure(self):
         """Configure the MongoDB connection."""
         # Handle deprecated configuration
@@ -146,12 +262,18 @@ class MongoDBPipeline(BaseItemExporter):
             ('collection', 'MONGODB_COLLECTION'),
             ('separate_collections', 'MONGODB_SEPARATE_COLLECTIONS'),
             ('replica_set', 'MONGODB_REPLICA_SET'),
+            ('max_pool_size', 'MONGODB_MAX_POOL_SIZE'),
+            ('min_pool_size', 'MONGODB_MIN_POOL_SIZE'),
+            ('compressors', 'MONGODB_COMPRESSORS'),
             ('unique_key', 'MONGODB_UNIQUE_KEY'),
             ('buffer', 'MONGODB_BUFFER_DATA'),
+            ('buffer_bytes', 'MONGODB_BUFFER_BYTES'),
+            ('thread_pool_size', 'MONGODB_THREAD_POOL_SIZE'),
             ('append_timestamp', 'MONGODB_ADD_TIMESTAMP'),
             ('stop_on_duplicate', 'MONGODB_STOP_ON_DUPLICATE'),
             ('grid_fs_threshold_bytes', 'MONGODB_GRID_FS_THRESHOLD_BYTES'),
-            ('grid_fs_field_tag', 'MONGODB_GRID_FS_FIELD_TAG')
+            ('grid_fs_field_tag', 'MONGODB_GRID_FS_FIELD_TAG'),
+            ('grid_fs_chunk_size', 'MONGODB_GRID_FS_CHUNK_SIZE')
         ]
 
         for key, setting in options:
@@ -159,10 +281,10 @@ class MongoDBPipeline(BaseItemExporter):
                 self.config[key] = self.settings[setting]
 
         # Check for illegal configuration
-        if self.config['buffer'] and self.config['unique_key']:
+        if self.config['grid_fs_chunk_size'] <= 0:
             msg = (
-                u'IllegalConfig: Settings both MONGODB_BUFFER_DATA '
-                u'and MONGODB_UNIQUE_KEY is not supported'
+                u'IllegalConfig: MONGODB_GRID_FS_CHUNK_SIZE must be '
+                u'greater than 0'
             )
             self.logger.error(msg)
             raise SyntaxError(msg)
@@ -174,119 +296,299 @@ class MongoDBPipeline(BaseItemExporter):
         :param item: The item to put into MongoDB
         :type spider: BaseSpider object
         :param spider: The spider running the queries
-        :returns: Item object
+        :returns: Item object or a Deferred firing with the item once it
+            has been written to MongoDB
         """
 
         # Filter out fields which are explictely marked MONGODB_GRID_FS_FIELD_TAG (default = 'big_field').
-        grid_fields = list(
-            dict(
-                filter(lambda x: x[1].get(self.config['grid_fs_field_tag'], False) is True, item.fields.items())
-            ).keys()
-        )
+        # The fields are declared on the Item class, so they are only looked up once per class.
+        item_class = type(item)
+        grid_fields = self._grid_field_cache.get(item_class)
+        if grid_fields is None:
+            grid_fields = [
+                key for key, field in item.fields.items()
+                if field.get(self._grid_tag, False) is True
+            ]
+            self._grid_field_cache[item_class] = grid_fields
 
         item = dict(self._get_serialized_fields(item))
 
         # If MONGODB_GRID_FS_THRESHOLD_BYTES is set: 
         # Find the values where the item's measured size is greater than the max size (in bytes).
-        if self.config['grid_fs_threshold_bytes'] is not None:
-            max_size_bytes = self.config['grid_fs_threshold_bytes']
-            oversized = list(
-                dict(
-                    filter(lambda x: getsizeof(x[1]) > max_size_bytes, item.items())
-                ).keys()
-            )
-            grid_fields += oversized
+        if self._grid_thresh is not None:
+            max_size_bytes = self._grid_thresh
+            oversized = [
+                key for key, value in item.items()
+                if _exceeds_bytes(value, max_size_bytes) and key not in grid_fields
+            ]
+            grid_fields = grid_fields + oversized
 
-        item = dict((k, v) for k, v in six.iteritems(item) if v is not None and v != "")
+        item = {k: v for k, v in item.items() if v is not None and v != ""}
 
-        if self.config['buffer']:
+        if self._buf_size or self._buf_bytes:
             self.current_item += 1
-            self.item_buffer.append((item, grid_fields))
-            if self.current_item == self.config['buffer']:
+            if self._buf_bytes:
+                self.current_bytes += sum(_approx_bytes(v) for v in item.values())
+            # The item is passed on to the next pipelines right away, so the
+            # buffer keeps a copy for insert_item to modify in its thread
+            self._items_buf.append(dict(item))
+            self._grid_fields_buf.append(grid_fields)
+
+            # Flush when either the item count or the size limit is reached
+            if ((self._buf_size and self.current_item >= self._buf_size) or
+                    (self._buf_bytes and self.current_bytes >= self._buf_bytes)):
                 self.current_item = 0
+                self.current_bytes = 0
                 try:
-                    return self.insert_item(self.item_buffer, spider)
+                    d = self.defer_to_thread(
+                        self.insert_item,
+                        self._items_buf,
+                        self._grid_fields_buf,
+                        spider)
+                    d.addCallback(lambda _: item)
+                    return d
                 finally:
-                    self.item_buffer = []
+                    self._items_buf = []
+                    self._grid_fields_buf = []
             return item
 
-        return self.insert_item((item, grid_fields), spider)
+        d = self.defer_to_thread(
+            self.insert_item, [item], [grid_fields], spider)
+        d.addCallback(lambda _: item)
+        return d
 
     def close_spider(self, spider):
         """Be called when the spider is closed.
 
         :type spider: BaseSpider object
         :param spider: The spider running the queries
-        :returns: None
+        :returns: None or a Deferred firing once the buffer has been written
         """
-        if self.item_buffer:
-            self.insert_item(self.item_buffer, spider)
+        if self._items_buf:
+            d = self.defer_to_thread(
+                self.insert_item,
+                self._items_buf,
+                self._grid_fields_buf,
+                spider)
+            d.addBoth(self.stop_thread_pool)
+            return d
+
+        self.stop_thread_pool()
+
+    def defer_to_thread(self, f, *args):
+        """Run a blocking function in the pipeline's thread pool.
+
+        :type f: callable
+        :param f: The function to run
+        :returns: Deferred firing with the result of the function
+        """
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(reactor, self.thread_pool, f, *args)
 
-    def insert_item(self, item_container, spider):
-        """Process the item and add it to MongoDB.
+    def stop_thread_pool(self, result=None):
+        """Stop the pipeline's thread pool.
 
-        :type item: Tuple((Item object) or [(Item object)], [str])
-        :param item: The item(s) to put into MongoDB and the grid_fs field keys.
+        :param result: Passed through, so this can be used as a callback
+        :returns: The result
+        """
+        from twisted.internet import reactor
+        reactor.removeSystemEventTrigger(self._thread_pool_trigger)
+        self.thread_pool.stop()
+        return result
+
+    def insert_item(self, items, grid_fields, spider):
+        """Process the items and add them to MongoDB.
+
+        This method does blocking network I/O and is run in the pipeline's
+        thread pool, outside of the reactor thread.
+
+        :type items: [dict]
+        :param items: The items to put into MongoDB
+        :type grid_fields: [[str]]
+        :param grid_fields: The grid_fs field keys, per item
         :type spider: BaseSpider object
         :param spider: The spider running the queries
-        :returns: Item object
+        :returns: [dict] - The stored items
         """
-
-        if not isinstance(item_container, list):
-            item = item_container[0]
-            grid_fields = item_container[1]
-            for key in item:
-                if key in grid_fields:
-                    file_key = self.grid_fs.put(str(item[key]), encoding='utf-8')
-                    item[key] = file_key
-            if self.config['append_timestamp']:
-                item['scrapy-mongodb'] = {'ts': datetime.datetime.utcnow()}
-        else:
-            item = []
-            for ic in item_container:
-                new_item = ic[0]
-                grid_fields = ic[1]
-                for key in new_item:
-                    if key in grid_fields:
-                        file_key = self.grid_fs.put(str(new_item[key]), encoding='utf-8')
-                        new_item[key] = file_key
-                if self.config['append_timestamp']:
-                    new_item['scrapy-mongodb'] = {'ts': datetime.datetime.utcnow()}
-                item.append(new_item)
+        # Items without the unique key are dropped before anything,
+        # including their GridFS fields, is written
+        if self._make_key is not None:
+            keys = []
+            kept_items = []
+            kept_grid_fields = []
+            for item, item_grid_fields in zip(items, grid_fields):
+                try:
+                    keys.append(self._make_key(item))
+                except KeyError as e:
+                    self.logger.warning(
+                        u'Item is missing unique key field {0}, skipping it'.format(e))
+                    continue
+                kept_items.append(item)
+                kept_grid_fields.append(item_grid_fields)
+            items = kept_items
+            grid_fields = kept_grid_fields
+
+        grid_values = []
+        # All items of the batch share the same insertion timestamp
+        if self._append_ts:
+            stamp = {'ts': datetime.datetime.utcnow()}
+        for item, item_grid_fields in zip(items, grid_fields):
+            # Empty values have been dropped from the item
+            for key in item_grid_fields:
+                if key in item:
+                    grid_values.append((item, key))
+            if self._append_ts:
+                item['scrapy-mongodb'] = stamp.copy()
+        self.store_grid_fields(grid_values)
 
         collection_name, collection = self.get_collection(spider.name)
 
-        if self.config['unique_key'] is None:
-            try:
-                collection.insert(item, continue_on_error=True)
-                self.logger.debug(u'Stored item(s) in MongoDB {0}/{1}'.format(
-                    self.config['database'], collection_name))
-
-            except errors.DuplicateKeyError:
-                self.logger.debug(u'Duplicate key found')
-                if (self.stop_on_duplicate > 0):
-                    self.duplicate_key_count += 1
-                    if (self.duplicate_key_count >= self.stop_on_duplicate):
-                        self.crawler.engine.close_spider(
-                            spider,
-                            'Number of duplicate key insertion exceeded'
-                        )
+        duplicates = 0
+        failure = None
+
+        if self._unique_key is None:
+            if len(items) == 1:
+                try:
+                    collection.insert_one(items[0])
+                except errors.DuplicateKeyError:
+                    duplicates += 1
+            else:
+                # The driver splits the batch by the server's
+                # maxWriteBatchSize and, unordered, writes all of it even if
+                # some documents fail. Other errors than duplicate keys are
+                # raised once the duplicates have been counted.
+                try:
+                    collection.insert_many(items, ordered=False)
+                except errors.BulkWriteError as bwe:
+                    write_errors = bwe.details.get('writeErrors', [])
+                    duplicate_errors = [
+                        error for error in write_errors
+                        if error.get('code') == 11000
+                    ]
+                    if len(duplicate_errors) != len(write_errors):
+                        failure = bwe
+                    duplicates += len(duplicate_errors)
 
         else:
-            key = {}
+            requests = [
+                ReplaceOne(key, item, upsert=True)
+                for key, item in zip(keys, items)
+            ]
+
+            # Ordered, so that the last scraped of several items with the
+            # same key is the one that ends up stored. An ordered write stops
+            # at its first error, so the requests after it are sent again.
+            pending = requests
+            while pending:
+                try:
+                    collection.bulk_write(pending, ordered=True)
+                    pending = []
+                except errors.BulkWriteError as bwe:
+                    write_errors = bwe.details.get('writeErrors')
+                    if not write_errors:
+                        raise
+                    if write_errors[0].get('code') == 11000:
+                        duplicates += 1
+                    elif failure is None:
+                        failure = bwe
+                    pending = pending[write_errors[0]['index'] + 1:]
+
+        if duplicates:
+            self.logger.debug(u'{0} duplicate key(s) found'.format(duplicates))
+            # Counted in the reactor thread, where the engine lives
+            from twisted.internet import reactor
+            reactor.callFromThread(self.count_duplicates, duplicates, spider)
+        elif failure is None:
+            self.logger.debug(u'Stored item(s) in MongoDB {0}/{1}'.format(
+                self.database.name, collection_name))
+
+        if failure is not None:
+            raise failure
 
-            if isinstance(self.config['unique_key'], list):
-                for k in dict(self.config['unique_key']).keys():
-                    key[k] = item[k]
+        return items
+
+    def store_grid_fields(self, grid_values):
+        """Store field values in GridFS and replace them with the file ids.
+
+        The chunks of all files are written with one insert_many call and
+        the files documents with another, instead of one gridfs.put call
+        (and at least two round-trips) per field.
+
+        :type grid_values: [(dict, str)]
+        :param grid_values: The documents and keys of the fields to store
+        :returns: None
+        """
+        if not grid_values:
+            return
+
+        # GridFS files are written by the pipeline, not by the gridfs
+        # module, so its indexes are ensured here the first time it is used
+        if not self._grid_fs_indexed:
+            self.grid_fs_chunks.create_index(
+                [('files_id', 1), ('n', 1)], unique=True)
+            self.grid_fs_files.create_index([('filename', 1), ('uploadDate', 1)])
+            self._grid_fs_indexed = True
+
+        chunk_size = self.config['grid_fs_chunk_size']
+        upload_date = datetime.datetime.utcnow()
+        files = []
+        chunks = []
+        for document, key in grid_values:
+            value = document[key]
+            file_id = ObjectId()
+            grid_file = {
+                '_id': file_id,
+                'chunkSize': chunk_size,
+                'uploadDate': upload_date,
+            }
+
+            # Binary values are stored as they are, anything else as UTF-8 text
+            if isinstance(value, memoryview):
+                value = value.tobytes()
+            if isinstance(value, (bytes, bytearray)):
+                data = value
             else:
-                key[self.config['unique_key']] = item[self.config['unique_key']]
+                data = str(value).encode('utf-8')
+                grid_file['encoding'] = 'utf-8'
 
-            collection.update(key, item, upsert=True)
+            for n, offset in enumerate(range(0, len(data), chunk_size)):
+                chunks.append({
+                    'files_id': file_id,
+                    'n': n,
+                    'data': Binary(data[offset:offset + chunk_size]),
+                })
 
-            self.logger.debug(u'Stored item(s) in MongoDB {0}/{1}'.format(
-                self.config['database'], collection_name))
+            grid_file['length'] = len(data)
+            files.append(grid_file)
+            document[key] = file_id
+
+        # Chunks go first so a file is never visible without its data
+        if chunks:
+            self.grid_fs_chunks.insert_many(chunks, ordered=False)
+        self.grid_fs_files.insert_many(files, ordered=False)
 
-        return item
+    def count_duplicates(self, count, spider):
+        """Register duplicate key insertions and close the spider when the
+        MONGODB_STOP_ON_DUPLICATE threshold is reached.
+
+        Must be called from the reactor thread.
+
+        :type count: int
+        :param count: Number of duplicate keys found
+        :type spider: BaseSpider object
+        :param spider: The spider running the queries
+        :returns: None
+        """
+        if self.stop_on_duplicate > 0:
+            previous_count = self.duplicate_key_count
+            self.duplicate_key_count += count
+
+            # Only close the spider when the threshold is crossed
+            if previous_count < self.stop_on_duplicate <= self.duplicate_key_count:
+                self.crawler.engine.close_spider(
+                    spider,
+                    'Number of duplicate key insertion exceeded'
+                )
 
     def get_collection(self, name):
         if self.config['separate_collections']:
@@ -300,9 +602,10 @@ class MongoDBPipeline(BaseItemExporter):
             collection = self.collections.get('default')
             collection_name = self.config['collection']
 
-        # Ensure unique index
-        if self.config['unique_key']:
-            collection.ensure_index(self.config['unique_key'], unique=True)
+        # Ensure unique index, once per collection
+        if self._unique_key and collection_name not in self._indexed_collections:
+            collection.create_index(self._unique_key, unique=True)
+            self._indexed_collections.add(collection_name)
             self.logger.info(u'Ensuring index for key {0}'.format(
-                self.config['unique_key']))
+                self._unique_key))
         return (collection_name, collection)
@@ -15,14 +15,14 @@ setup(
     py_modules=['scrapy_mongodb'],
     platforms=['Any'],
     install_requires=[
-        'pymongo >= 2.4.1',
-        'six >= 1.11.0'
+        'pymongo >= 3.0'
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Console',
         'License :: OSI Approved :: Apache Software License',
         'Operating System :: OS Independent',
-        'Programming Language :: Python'
+        'Programming Language :: Python',
+        'Programming Language :: Python :: 3'
     ]
 )
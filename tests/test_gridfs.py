@@ -0,0 +1,82 @@
+"""Tests for the GridFS files written by the pipeline."""
+import unittest
+
+import gridfs
+import mongomock
+import mongomock.gridfs
+
+from scrapy_mongodb import MongoDBPipeline
+
+
+mongomock.gridfs.enable_gridfs_integration()
+
+
+class Pipeline(MongoDBPipeline):
+    """Pipeline that can be instantiated without a spider."""
+
+    def export_item(self, item):
+        pass
+
+
+class StoreGridFieldsTest(unittest.TestCase):
+    """Files written by store_grid_fields must be readable with gridfs."""
+
+    def make_pipeline(self, chunk_size):
+        pipeline = Pipeline()
+        pipeline.config = dict(MongoDBPipeline.config, grid_fs_chunk_size=chunk_size)
+        pipeline.database = mongomock.MongoClient().db
+        pipeline.grid_fs_files = pipeline.database['fs.files']
+        pipeline.grid_fs_chunks = pipeline.database['fs.chunks']
+        return pipeline
+
+    def store(self, pipeline, value):
+        document = {'field': value}
+        pipeline.store_grid_fields([(document, 'field')])
+        return gridfs.GridFS(pipeline.database).get(document['field'])
+
+    def test_text_round_trip(self):
+        text = u'h\xe9llo w\xf6rld ☃'
+        data = text.encode('utf-8')
+        for chunk_size in (1, 4, len(data), len(data) // 2, 255 * 1024):
+            pipeline = self.make_pipeline(chunk_size)
+            grid_out = self.store(pipeline, text)
+
+            self.assertEqual(grid_out.read(), data)
+            self.assertEqual(grid_out.encoding, 'utf-8')
+            self.assertEqual(grid_out.chunk_size, chunk_size)
+
+    def test_bytes_round_trip(self):
+        data = bytes(bytearray(range(256))) * 3
+        for chunk_size in (1, 7, 256, 255 * 1024):
+            pipeline = self.make_pipeline(chunk_size)
+            grid_out = self.store(pipeline, data)
+
+            self.assertEqual(grid_out.read(), data)
+            self.assertNotIn('encoding', pipeline.grid_fs_files.find_one())
+
+    def test_exact_multiple_of_chunk_size(self):
+        chunk_size = 16
+        data = b'x' * (chunk_size * 3)
+        pipeline = self.make_pipeline(chunk_size)
+        grid_out = self.store(pipeline, data)
+
+        self.assertEqual(grid_out.read(), data)
+        self.assertEqual(pipeline.grid_fs_chunks.count_documents({}), 3)
+
+    def test_empty_value(self):
+        pipeline = self.make_pipeline(16)
+        grid_out = self.store(pipeline, b'')
+
+        self.assertEqual(grid_out.read(), b'')
+        self.assertEqual(pipeline.grid_fs_chunks.count_documents({}), 0)
+
+    def test_several_fields_in_one_batch(self):
+        pipeline = self.make_pipeline(4)
+        documents = [{'a': b'first value'}, {'a': u'second', 'b': b'third'}]
+        pipeline.store_grid_fields([
+            (documents[0], 'a'), (documents[1], 'a'), (documents[1], 'b')])
+        fs = gridfs.GridFS(pipeline.database)
+
+        self.assertEqual(fs.get(documents[0]['a']).read(), b'first value')
+        self.assertEqual(fs.get(documents[1]['a']).read(), b'second')
+        self.assertEqual(fs.get(documents[1]['b']).read(), b'third')